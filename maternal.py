@@ -1,23 +1,115 @@
 import gradio as gr
 import google.generativeai as genai
-from transformers import pipeline
-from functools import lru_cache
+from transformers import AutoModelForSequenceClassification, AutoTokenizer, pipeline
+from collections import OrderedDict, deque
+import asyncio
 import re
 import os
-from typing import List, Tuple
+import random
+import threading
+import unicodedata
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+import numpy as np
+import torch
+
+# Static system prompt, sent as the model's system instruction
+SYSTEM_PROMPT = """
+As a maternal health assistant, provide ONE complete, supportive response to the user's latest message.
+Be emotionally appropriate and informative.
+
+Your job include:
+ -Always take care of tone
+ -Never let patient panic and talk supportively
+"""
 
 # Configure Gemini
 GEMINI_API_KEY = "_"
 try:
     genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel('gemini-1.5-flash')
+    model = genai.GenerativeModel('gemini-1.5-flash', system_instruction=SYSTEM_PROMPT)
     gemini_available = True
 except Exception as e:
     print(f"Gemini error: {e}")
     gemini_available = False
 
 # Load Hugging Face emotion classifier
-emotion_classifier = pipeline("text-classification", model="j-hartmann/emotion-english-distilroberta-base", return_all_scores=True)
+EMOTION_MODEL_NAME = "j-hartmann/emotion-english-distilroberta-base"
+EMOTION_MAX_LENGTH = 64
+EMOTION_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "emotion-int8")
+EMOTION_ONNX_FILE = "model_quantized.onnx"
+
+def cpu_supports_bf16() -> bool:
+    # Native BF16 only (AVX512-BF16 or AMX); oneDNN also reports BF16 on plain AVX-512 cores,
+    # where it is emulated and slower than the INT8 path
+    cpu = getattr(torch._C, '_cpu', None)
+    for check in ('_is_avx512_bf16_supported', '_is_amx_tile_supported'):
+        try:
+            if getattr(cpu, check)():
+                return True
+        except Exception:
+            pass
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = next((line.split() for line in f if line.startswith('flags')), [])
+        return 'avx512_bf16' in flags or 'amx_bf16' in flags
+    except OSError:
+        return False
+
+def load_torch_classifier(tokenizer):
+    # BF16 weights with fused attention (BetterTransformer) or torch.compile on BF16-capable CPUs,
+    # dynamic INT8 Linear layers elsewhere
+    if not cpu_supports_bf16():
+        model = AutoModelForSequenceClassification.from_pretrained(EMOTION_MODEL_NAME)
+        # BetterTransformer reads the float Linear weights, so it cannot wrap the quantized model
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return pipeline("text-classification", model=model, tokenizer=tokenizer)
+
+    model = AutoModelForSequenceClassification.from_pretrained(EMOTION_MODEL_NAME, torch_dtype=torch.bfloat16)
+    classifier = pipeline("text-classification", model=model, tokenizer=tokenizer)
+    try:
+        from optimum.bettertransformer import BetterTransformer
+        classifier.model = BetterTransformer.transform(classifier.model, keep_original_model=False)
+    except Exception as e:
+        print(f"BetterTransformer unavailable, trying torch.compile: {e}")
+        try:
+            # Compilation is lazy; warm_up_models triggers it in the background
+            classifier.model = torch.compile(classifier.model, dynamic=True)
+        except Exception as e:
+            print(f"torch.compile unavailable: {e}")
+    return classifier
+
+def load_emotion_classifier():
+    # Dynamic INT8 ONNX export of the classifier, cached in EMOTION_MODEL_DIR across restarts;
+    # falls back to the PyTorch pipeline
+    tokenizer = AutoTokenizer.from_pretrained(EMOTION_MODEL_NAME)
+    try:
+        import onnxruntime as ort
+        from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+        if not os.path.exists(os.path.join(EMOTION_MODEL_DIR, EMOTION_ONNX_FILE)):
+            ort_model = ORTModelForSequenceClassification.from_pretrained(EMOTION_MODEL_NAME, export=True)
+            quantizer = ORTQuantizer.from_pretrained(ort_model)
+            qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+            quantizer.quantize(save_dir=EMOTION_MODEL_DIR, quantization_config=qconfig)
+
+        session_options = ort.SessionOptions()
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session_options.intra_op_num_threads = max(1, (os.cpu_count() or 2) // 2)
+        quantized_model = ORTModelForSequenceClassification.from_pretrained(
+            EMOTION_MODEL_DIR,
+            file_name=EMOTION_ONNX_FILE,
+            provider="CPUExecutionProvider",
+            session_options=session_options
+        )
+        return pipeline("text-classification", model=quantized_model, tokenizer=tokenizer)
+    except Exception as e:
+        print(f"Quantized emotion model unavailable, using PyTorch: {e}")
+        return load_torch_classifier(tokenizer)
+
+emotion_classifier = load_emotion_classifier()
+# Held around every classifier call so warm_up_models can swap the model safely
+emotion_classifier_lock = threading.Lock()
 
 # Response templates
 RESPONSE_TEMPLATES = {
@@ -92,63 +184,309 @@ MOOD_CONFIG = {
     }
 }
 
-@lru_cache(maxsize=50)
-def detect_emotion(text: str) -> str:
-    result = emotion_classifier(text)[0]
-    top_emotion = max(result, key=lambda x: x['score'])['label']
-    if top_emotion in ['fear']: return 'scared'
-    elif top_emotion in ['anger']: return 'frustrated'
-    elif top_emotion in ['sadness', 'confusion']: return 'confused'
-    elif top_emotion in ['joy']: return 'positive'
-    return 'neutral'
-
-def analyze_mood(text: str) -> Tuple[str, str]:
-    text_lower = text.lower()
-    if any(keyword in text_lower for keyword in MOOD_CONFIG['medical']['keywords']):
-        symptom = next((s for s in MOOD_CONFIG['medical']['keywords'] if s in text_lower), 'default')
-        return 'medical', symptom
+def make_fallback(mood: str):
+    # Template arguments are resolved once per context; only the template choice happens per call
+    config = MOOD_CONFIG.get(mood, {})
+    templates = RESPONSE_TEMPLATES[mood]
+    sections = {'info': config.get('info', {}), 'suggestion': config.get('suggestions', {}), 'symptom': config.get('symptoms', {})}
+    contexts = {'default'}.union(*sections.values())
+    format_args = {
+        context: dict(mood=mood, **{name: values.get(context, '') for name, values in sections.items()})
+        for context in contexts
+    }
+    empty_args = dict(mood=mood, info='', suggestion='', symptom='')
+
+    def fallback(context: str = 'default') -> str:
+        return random.choice(templates).format(**format_args.get(context, empty_args))
+    return fallback
+
+FALLBACK = {mood: make_fallback(mood) for mood in RESPONSE_TEMPLATES}
+
+# Keyword -> mood lookup; medical keywords win over the other moods
+KEYWORD_TO_MOOD = {
+    keyword: mood
+    for mood in sorted(MOOD_CONFIG, key=lambda m: m == 'medical')
+    for keyword in MOOD_CONFIG[mood]['keywords']
+}
+# Leading word boundary only, so "contractions" and "fearful" still match
+KEYWORD_RE = re.compile(r'\b(' + '|'.join(
+    re.escape(k) for k in sorted(KEYWORD_TO_MOOD, key=len, reverse=True)
+) + r')')
+
+# Single-pass Aho-Corasick scan over all keywords when pyahocorasick is installed
+try:
+    import ahocorasick
+    KEYWORD_AUTOMATON = ahocorasick.Automaton()
+    for keyword, keyword_mood in KEYWORD_TO_MOOD.items():
+        KEYWORD_AUTOMATON.add_word(keyword, (keyword, keyword_mood))
+    KEYWORD_AUTOMATON.make_automaton()
+except ImportError:
+    KEYWORD_AUTOMATON = None
+
+def iter_keywords(text_lower: str) -> Iterator[Tuple[str, str]]:
+    if KEYWORD_AUTOMATON is None:
+        for match in KEYWORD_RE.finditer(text_lower):
+            yield match.group(1), KEYWORD_TO_MOOD[match.group(1)]
+        return
+    for end, (keyword, keyword_mood) in KEYWORD_AUTOMATON.iter(text_lower):
+        start = end - len(keyword) + 1
+        # Same leading word boundary as KEYWORD_RE
+        if start == 0 or not (text_lower[start - 1].isalnum() or text_lower[start - 1] == '_'):
+            yield keyword, keyword_mood
+
+EMOTION_MAP = {
+    'fear': 'scared',
+    'anger': 'frustrated',
+    'sadness': 'confused',
+    'confusion': 'confused',
+    'joy': 'positive'
+}
+
+class EmotionBatcher:
+    """Coalesces concurrent detect_emotion_async calls into one batched classifier pass."""
+
+    def __init__(self, classifier, max_batch: int = 16, max_wait: float = 0.015):
+        self.classifier = classifier
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = deque()
+        self._loop = None
+        self._ready = None
+        self._worker = None
+
+    async def classify(self, text: str) -> str:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._worker.done():
+            self._loop = loop
+            self._ready = asyncio.Event()
+            self._worker = loop.create_task(self._run())
+        future = loop.create_future()
+        self.queue.append((text, future))
+        self._ready.set()
+        return await future
+
+    def _classify_batch(self, texts: List[str]) -> List[List[dict]]:
+        with emotion_classifier_lock:
+            return self.classifier(
+                texts, batch_size=len(texts),
+                truncation=True, max_length=EMOTION_MAX_LENGTH, padding=True, top_k=1
+            )
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            if len(self.queue) < self.max_batch:
+                await asyncio.sleep(self.max_wait)
+            batch = [self.queue.popleft() for _ in range(min(len(self.queue), self.max_batch))]
+            if not self.queue:
+                self._ready.clear()
+            texts = [text for text, _ in batch]
+            try:
+                # Label mapping stays inside the try so an unexpected output shape fails the
+                # batch's futures instead of killing the worker and leaving them pending
+                results = await asyncio.to_thread(self._classify_batch, texts)
+                moods = [EMOTION_MAP.get(result[0]['label'], 'neutral') for result in results]
+                if len(moods) != len(batch):
+                    raise ValueError(f"Expected {len(batch)} classifier results, got {len(moods)}")
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), mood in zip(batch, moods):
+                if not future.done():
+                    future.set_result(mood)
+
+emotion_batcher = EmotionBatcher(emotion_classifier)
+EMOTION_CACHE_SIZE = 512
+emotion_cache = OrderedDict()
+
+def emotion_cache_key(text: str) -> str:
+    # Punctuation and symbols (emoji included) become spaces, letters and combining marks of any
+    # script are kept, so "Scared!!" and "Scared" share one entry. Case is kept because the
+    # classifier is case-sensitive ("I'M SO ANGRY" scores differently from its lowercase form)
+    return " ".join("".join(
+        " " if unicodedata.category(c)[0] in "PS" else c for c in text
+    ).split())
+
+async def detect_emotion_async(text: str) -> str:
+    key = emotion_cache_key(text)
+    if not key:
+        # Emoji- or punctuation-only messages would all collide on the empty key
+        return await emotion_batcher.classify(text)
+    if key in emotion_cache:
+        emotion_cache.move_to_end(key)
+        return emotion_cache[key]
+    mood = await emotion_batcher.classify(text)
+    emotion_cache[key] = mood
+    if len(emotion_cache) > EMOTION_CACHE_SIZE:
+        emotion_cache.popitem(last=False)
+    return mood
+
+# Keyword matching takes already-lowercased text so each message is lowered once
+def match_keywords(text_lower: str) -> Optional[Tuple[str, str]]:
+    keyword_mood = None
+    for keyword, mood in iter_keywords(text_lower):
+        if mood == 'medical':
+            return 'medical', keyword
+        keyword_mood = keyword_mood or mood
+    if keyword_mood:
+        return keyword_mood, 'default'
+    return None
+
+async def classify_mood(text: str) -> Tuple[str, str]:
     try:
-        mood = detect_emotion(text)
-    except:
+        mood = await detect_emotion_async(text)
+    except Exception:
         mood = 'neutral'
     context = 'default'
     return mood, context
 
-@lru_cache(maxsize=50)
-def get_gemini_response(prompt: str) -> str:
-    return model.generate_content(prompt).text
+class SemanticCache:
+    """Reuses Gemini responses for user messages that embed close to an earlier one."""
 
-def generate_response(message: str, chat_history: List[Tuple[str, str]] = []) -> str:
-    mood, context = analyze_mood(message)
-    history_text = "\n".join([f"User: {u}\nAssistant: {a}" for u, a in chat_history[-3:]])
-    prompt = f"""
-As a maternal health assistant, provide ONE complete, supportive response to this {mood} message.
-Be emotionally appropriate and informative.
+    def __init__(self, encoder, maxsize: int = 200, threshold: float = 0.92):
+        self.encoder = encoder
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.embeddings = []
+        self.responses = []
+        self._matrix = None
 
-Your job include:
- -Always take care of tone
- -Never let patient panic and talk supportively
+    def embed(self, text_lower: str) -> np.ndarray:
+        normalized = " ".join(text_lower.split())
+        return self.encoder.encode(normalized, normalize_embeddings=True)
 
+    def get(self, embedding: np.ndarray) -> Optional[str]:
+        if not self.embeddings:
+            return None
+        if self._matrix is None:
+            self._matrix = np.vstack(self.embeddings)
+        scores = self._matrix @ embedding
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        self._move_to_end(best)
+        return self.responses[-1]
+
+    def put(self, embedding: np.ndarray, response: str):
+        self.embeddings.append(embedding)
+        self.responses.append(response)
+        if len(self.embeddings) > self.maxsize:
+            del self.embeddings[0], self.responses[0]
+        self._matrix = None
+
+    def _move_to_end(self, index: int):
+        self.embeddings.append(self.embeddings.pop(index))
+        self.responses.append(self.responses.pop(index))
+        self._matrix = None
+
+try:
+    from sentence_transformers import SentenceTransformer
+    response_cache = SemanticCache(SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2"))
+except Exception as e:
+    print(f"Semantic cache disabled: {e}")
+    response_cache = None
+
+def warm_up_models():
+    # Pays cold-start costs (compile, ORT session, encoder) before the first user does;
+    # requests arriving meanwhile wait on emotion_classifier_lock
+    with emotion_classifier_lock:
+        for _ in range(2):
+            try:
+                emotion_classifier("warmup text", truncation=True, max_length=EMOTION_MAX_LENGTH, top_k=1)
+            except Exception as e:
+                print(f"Emotion classifier warmup failed: {e}")
+                # A failed torch.compile surfaces here; fall back to the eager model
+                eager_model = getattr(emotion_classifier.model, '_orig_mod', None)
+                if eager_model is None:
+                    break
+                emotion_classifier.model = eager_model
+    if response_cache is not None:
+        try:
+            response_cache.embed("warmup text")
+        except Exception as e:
+            print(f"Semantic cache warmup failed: {e}")
+
+threading.Thread(target=warm_up_models, daemon=True).start()
+
+async def stream_gemini_response(prompt: str, message_lower: str, use_cache: bool = False) -> AsyncIterator[str]:
+    # Yields the response accumulated so far; with use_cache the assembled text is cached once the stream ends
+    embedding = None
+    if use_cache and response_cache is not None:
+        try:
+            embedding = await asyncio.to_thread(response_cache.embed, message_lower)
+            cached = response_cache.get(embedding)
+        except Exception as e:
+            # A cache failure only means no caching, not a template fallback
+            print(f"Semantic cache error: {e}")
+            embedding, cached = None, None
+        if cached is not None:
+            yield cached
+            return
+    response = ""
+    stream = await model.generate_content_async(prompt, stream=True)
+    async for chunk in stream:
+        response += chunk.text
+        yield response
+    if embedding is not None:
+        response_cache.put(embedding, response)
+
+HISTORY_TURNS = 3
+
+def append_turn(history_turns: List[str], user: str, assistant: str) -> List[str]:
+    # Each turn is formatted once and the last HISTORY_TURNS are kept for the prompt
+    return (history_turns + [f"User: {user}\nAssistant: {assistant}"])[-HISTORY_TURNS:]
+
+def build_prompt(message: str, history_text: str, mood: Optional[str] = None) -> str:
+    mood_line = f"The latest message sounds {mood}.\n" if mood else ""
+    return f"""
+{mood_line}
 Conversation:
 {history_text}
 
 User: {message}
 Assistant:
 """
-    try:
-        if gemini_available:
-            return get_gemini_response(prompt)
-    except Exception as e:
-        print(f"Gemini error: {e}")
 
-    # fallback to template
-    templates = RESPONSE_TEMPLATES.get(mood, RESPONSE_TEMPLATES['neutral'])
-    return templates[0].format(
-        mood=mood,
-        info=MOOD_CONFIG.get(mood, {}).get('info', {}).get(context, ''),
-        suggestion=MOOD_CONFIG.get(mood, {}).get('suggestions', {}).get(context, ''),
-        symptom=MOOD_CONFIG.get(mood, {}).get('symptoms', {}).get(context, '')
-    )
+async def generate_response_stream(message: str, history_text: str = "") -> AsyncIterator[Tuple[str, Optional[str]]]:
+    # Yields (partial response, mood); mood is None until the classifier finishes
+    message_lower = message.lower()
+    keyword_match = match_keywords(message_lower)
+    mood_task = None
+    if keyword_match:
+        mood, context = keyword_match
+    else:
+        # No keyword hit: run the classifier alongside Gemini, which judges the tone itself
+        mood, context = None, 'default'
+        mood_task = asyncio.create_task(classify_mood(message))
+
+    response = None
+    if gemini_available:
+        try:
+            # The cache is shared across sessions and keyed on the message alone, so only
+            # conversation openers (no history to answer in context of) may use it. Medical
+            # messages and anything with numbers (weeks, doses) embed too close to each other
+            # for a reused answer to be safe
+            use_cache = not history_text and mood != 'medical' and not any(c.isdigit() for c in message)
+            prompt = build_prompt(message, history_text, mood)
+            async for response in stream_gemini_response(prompt, message_lower, use_cache=use_cache):
+                if mood_task is not None and mood_task.done():
+                    mood, context = mood_task.result()
+                    mood_task = None
+                yield response, mood
+        except Exception as e:
+            # chunk.text also raises on chunks without parts (e.g. safety blocks); a half-streamed
+            # answer is replaced by the template so it never reaches the chat or history_turns
+            print(f"Gemini error: {e}")
+            response = None
+    if mood_task is not None:
+        mood, context = await mood_task
+
+    if not response:
+        # fallback to template
+        response = FALLBACK.get(mood, FALLBACK['neutral'])(context)
+    yield response, mood
 
 # Gradio UI
 with gr.Blocks(theme=gr.themes.Soft(), css="""
@@ -188,23 +526,32 @@ with gr.Blocks(theme=gr.themes.Soft(), css="""
 
     mood_display = gr.HTML()
 
-    def respond(message: str, chat_history: List[Tuple[str, str]]):
-        if not message.strip():
-            return chat_history, "", ""
-        response = generate_response(message, chat_history)
-        mood, _ = analyze_mood(message)
+    history_state = gr.State([])
+
+    def mood_indicator(mood: Optional[str]) -> str:
+        if mood is None:
+            return ""
         mood_data = MOOD_CONFIG.get(mood, {'color': '#e3f2fd'})
-        chat_history.append((message, response))
-        mood_html = f"""
+        return f"""
         <div class=\"mood-indicator\" style=\"background:{mood_data['color']}\">
             Detected: {mood.capitalize()}
         </div>
         """
-        return chat_history, "", mood_html
 
-    msg.submit(respond, [msg, chatbot], [chatbot, msg, mood_display])
-    submit_btn.click(respond, [msg, chatbot], [chatbot, msg, mood_display])
-    clear_btn.click(lambda: ([], "", ""), None, [chatbot, msg, mood_display])
+    async def respond(message: str, chat_history: List[Tuple[str, str]], history_turns: List[str]):
+        if not message.strip():
+            yield chat_history, "", "", history_turns
+            return
+        chat_history.append((message, ""))
+        async for response, mood in generate_response_stream(message, "\n".join(history_turns)):
+            chat_history[-1] = (message, response)
+            yield chat_history, "", mood_indicator(mood), history_turns
+        history_turns = append_turn(history_turns, message, response)
+        yield chat_history, "", mood_indicator(mood), history_turns
+
+    msg.submit(respond, [msg, chatbot, history_state], [chatbot, msg, mood_display, history_state])
+    submit_btn.click(respond, [msg, chatbot, history_state], [chatbot, msg, mood_display, history_state])
+    clear_btn.click(lambda: ([], "", "", []), None, [chatbot, msg, mood_display, history_state])
 
 if __name__ == "__main__":
     demo.launch()